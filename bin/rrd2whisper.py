@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
 import errno
+import functools
+import itertools
+import multiprocessing
 import os
+import re
 import sys
 import time
 import signal
@@ -17,6 +21,10 @@ try:
 except ImportError:
   raise SystemExit('[ERROR] Please make sure whisper is installed properly')
 
+izip = getattr(itertools, 'izip', zip)
+if sys.version_info >= (3, 0):
+  xrange = range
+
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
@@ -29,6 +37,14 @@ aggregationMethods.remove('absmax')
 # RRD doesn't have a 'absmin' type
 aggregationMethods.remove('absmin')
 
+# Flattened rrdtool.info keys of the old python-rrdtool API,
+# e.g. 'rra[0].pdp_per_row' and 'ds[load].type'
+RRA_KEY = re.compile(r'rra\[(\d+)\]\.(\w+)$')
+DS_KEY = re.compile(r'ds\[([^\]]+)\]\.')
+
+# Maximum number of datapoints handed to whisper.update_many at once
+UPDATE_CHUNK_SIZE = 50000
+
 option_parser = optparse.OptionParser(usage='''%prog rrd_path''')
 option_parser.add_option(
     '--xFilesFactor',
@@ -49,115 +65,175 @@ option_parser.add_option(
     "RRD file's source path.",
     default=None,
     type='string')
+option_parser.add_option(
+    '--jobs',
+    help="Number of datasources to migrate in parallel. Defaults to the " +
+    "number of CPUs, or 1 for a single datasource",
+    default=None,
+    type='int')
+
+
+def fetch_archive(rrd_path, consolidation, precision, points, now):
+  retention = precision * points
+  endTime = now - now % precision
+  startTime = endTime - retention
+  (time_info, columns, rows) = rrdtool.fetch(
+    rrd_path,
+    consolidation,
+    '-r', str(precision),
+    '-s', str(startTime),
+    '-e', str(endTime))
+  rows.pop()  # remove the last datapoint because RRD sometimes gives funky values
+  # Transpose the rows once so each datasource can grab its column whole
+  series = list(zip(*rows)) or [()] * len(columns)
+  return (time_info, dict(zip(columns, series)))
+
+
+def log(message):
+  # Write and flush whole lines so output from parallel workers doesn't
+  # interleave
+  sys.stdout.write(message + '\n')
+  sys.stdout.flush()
+
+
+def migrate_datasource(target, archives, xFilesFactor):
+  # series holds (time_info, values) for this datasource, one per archive
+  # starting from the lowest precision
+  (path, series) = target
+
+  whisper.create(path, archives, xFilesFactor=xFilesFactor)
+  size = os.stat(path).st_size
+  archiveConfig = ','.join(["%d:%d" % ar for ar in archives])
+  log("Created: %s (%d bytes) with archives: %s" % (path, size, archiveConfig))
 
-(options, args) = option_parser.parse_args()
-
-if len(args) < 1:
-  option_parser.print_help()
-  sys.exit(1)
+  log("Migrating data")
+  archiveNumber = len(archives) - 1
+  # Keep the new file open for the whole migration rather than reopening
+  # it for every chunk handed to update_many
+  with open(path, 'r+b', whisper.BUFFERING) as fh:
+    for (time_info, values) in series:
+      # Unknown values are dropped lazily while chunks are taken off the
+      # generator, so the filtered series is never built as a whole
+      datapoints = ((timestamp, float(value))
+                    for (timestamp, value) in izip(xrange(*time_info), values)
+                    if value is not None)
+      count = len(values) - values.count(None)
+      log(' migrating %d datapoints from archive %d' % (count, archiveNumber))
+      archiveNumber -= 1
+      while True:
+        chunk = list(itertools.islice(datapoints, UPDATE_CHUNK_SIZE))
+        if not chunk:
+          break
+        chunk.reverse()  # file_update_many expects the newest points first
+        whisper.file_update_many(fh, chunk)
+
+
+def main():
+  (options, args) = option_parser.parse_args()
+
+  if len(args) < 1:
+    option_parser.print_help()
+    sys.exit(1)
+
+  rrd_path = args[0]
 
-rrd_path = args[0]
+  try:
+    rrd_info = rrdtool.info(rrd_path)
+  except rrdtool.error as exc:
+    raise SystemExit('[ERROR] %s' % str(exc))
 
-try:
-  rrd_info = rrdtool.info(rrd_path)
-except rrdtool.error as exc:
-  raise SystemExit('[ERROR] %s' % str(exc))
-
-seconds_per_pdp = rrd_info['step']
-
-# Reconcile old vs new python-rrdtool APIs (yuck)
-# leave consistent 'rras' and 'datasources' lists
-if 'rra' in rrd_info:
-  rras = rrd_info['rra']
-else:
-  rra_indices = []
-  for key in rrd_info:
-    if key.startswith('rra['):
-      index = int(key.split('[')[1].split(']')[0])
-      rra_indices.append(index)
-
-  rra_count = max(rra_indices) + 1
-  rras = []
-  for i in range(rra_count):
-    rra_info = {}
-    rra_info['pdp_per_row'] = rrd_info['rra[%d].pdp_per_row' % i]
-    rra_info['rows'] = rrd_info['rra[%d].rows' % i]
-    rra_info['cf'] = rrd_info['rra[%d].cf' % i]
-    rra_info['xff'] = rrd_info['rra[%d].xff' % i]
-    rras.append(rra_info)
-
-if 'ds' in rrd_info:
-  datasources = rrd_info['ds'].keys()
-else:
-  ds_keys = [key for key in rrd_info if key.startswith('ds[')]
-  datasources = list(set(key[3:].split(']')[0] for key in ds_keys))
-
-# Grab the archive configuration
-relevant_rras = []
-for rra in rras:
-  if rra['cf'] == options.aggregationMethod.upper():
-    relevant_rras.append(rra)
-
-if not relevant_rras:
-  err = "[ERROR] Unable to find any RRAs with consolidation function: %s" % \
-        options.aggregationMethod.upper()
-  raise SystemExit(err)
-
-archives = []
-xFilesFactor = options.xFilesFactor
-for rra in relevant_rras:
-  precision = rra['pdp_per_row'] * seconds_per_pdp
-  points = rra['rows']
-  if not xFilesFactor:
-    xFilesFactor = rra['xff']
-  archives.append((precision, points))
-
-for datasource in datasources:
-  now = int(time.time())
-  suffix = '_%s' % datasource if len(datasources) > 1 else ''
+  seconds_per_pdp = rrd_info['step']
 
-  if options.destinationPath:
-    destination_path = options.destinationPath
-    if not os.path.isdir(destination_path):
-      try:
-        os.makedirs(destination_path)
-      except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(destination_path):
-          pass
-        else:
-          raise
-    rrd_file = os.path.basename(rrd_path).replace('.rrd', '%s.wsp' % suffix)
-    path = destination_path + '/' + rrd_file
+  # Reconcile old vs new python-rrdtool APIs (yuck)
+  # leave consistent 'rras' and 'datasources' lists
+  if 'rra' in rrd_info:
+    rras = rrd_info['rra']
   else:
-    path = rrd_path.replace('.rrd', '%s.wsp' % suffix)
+    rra_fields = {}
+    for key in rrd_info:
+      match = RRA_KEY.match(key)
+      if match:
+        rra_fields.setdefault(int(match.group(1)), {})[match.group(2)] = rrd_info[key]
+
+    rras = [rra_fields[i] for i in sorted(rra_fields)]
 
+  if 'ds' in rrd_info:
+    datasources = rrd_info['ds'].keys()
+  else:
+    matches = (DS_KEY.match(key) for key in rrd_info)
+    datasources = list(set(match.group(1) for match in matches if match))
+
+  # Grab the archive configuration
+  consolidation = options.aggregationMethod.upper()
+  relevant_rras = [rra for rra in rras if rra['cf'] == consolidation]
+
+  if not relevant_rras:
+    err = "[ERROR] Unable to find any RRAs with consolidation function: %s" % \
+          consolidation
+    raise SystemExit(err)
+
+  archives = []
+  xFilesFactor = options.xFilesFactor
+  for rra in relevant_rras:
+    precision = rra['pdp_per_row'] * seconds_per_pdp
+    points = rra['rows']
+    if not xFilesFactor:
+      xFilesFactor = rra['xff']
+    archives.append((precision, points))
+
+  # Every datasource is stored in each RRA, so each archive is fetched once
+  # here and every datasource only takes its own column from it
+  now = int(time.time())
+  fetched = [fetch_archive(rrd_path, consolidation, precision, points, now)
+             for (precision, points) in reversed(archives)]
+
+  targets = []
+  for datasource in datasources:
+    suffix = '_%s' % datasource if len(datasources) > 1 else ''
+
+    if options.destinationPath:
+      destination_path = options.destinationPath
+      if not os.path.isdir(destination_path):
+        try:
+          os.makedirs(destination_path)
+        except OSError as exc:  # Python >2.5
+          if exc.errno == errno.EEXIST and os.path.isdir(destination_path):
+            pass
+          else:
+            raise
+      rrd_file = os.path.basename(rrd_path).replace('.rrd', '%s.wsp' % suffix)
+      path = destination_path + '/' + rrd_file
+    else:
+      path = rrd_path.replace('.rrd', '%s.wsp' % suffix)
+    series = [(time_info, columns[datasource]) for (time_info, columns) in fetched]
+    targets.append((path, series))
+  del fetched
+
+  migrate = functools.partial(
+    migrate_datasource, archives=archives, xFilesFactor=xFilesFactor)
+
+  jobs = options.jobs or min(len(targets), multiprocessing.cpu_count())
   try:
-    whisper.create(path, archives, xFilesFactor=xFilesFactor)
+    if jobs > 1:
+      # Each datasource goes to its own whisper file, so they can be
+      # migrated independently of each other
+      pool = multiprocessing.Pool(jobs)
+      try:
+        for _ in pool.imap_unordered(migrate, targets):
+          pass
+      except BaseException:
+        pool.terminate()
+        raise
+      else:
+        pool.close()
+      finally:
+        pool.join()
+    else:
+      for target in targets:
+        migrate(target)
   except whisper.InvalidConfiguration as e:
     raise SystemExit('[ERROR] %s' % str(e))
-  size = os.stat(path).st_size
-  archiveConfig = ','.join(["%d:%d" % ar for ar in archives])
-  print("Created: %s (%d bytes) with archives: %s" % (path, size, archiveConfig))
 
-  print("Migrating data")
-  archiveNumber = len(archives) - 1
-  for precision, points in reversed(archives):
-    retention = precision * points
-    endTime = now - now % precision
-    startTime = endTime - retention
-    (time_info, columns, rows) = rrdtool.fetch(
-      rrd_path,
-      options.aggregationMethod.upper(),
-      '-r', str(precision),
-      '-s', str(startTime),
-      '-e', str(endTime))
-    column_index = list(columns).index(datasource)
-    rows.pop()  # remove the last datapoint because RRD sometimes gives funky values
-
-    values = [row[column_index] for row in rows]
-    timestamps = list(range(*time_info))
-    datapoints = zip(timestamps, values)
-    datapoints = [datapoint for datapoint in datapoints if datapoint[1] is not None]
-    print(' migrating %d datapoints from archive %d' % (len(datapoints), archiveNumber))
-    archiveNumber -= 1
-    whisper.update_many(path, datapoints)
+
+if __name__ == '__main__':
+  main()
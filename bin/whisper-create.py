@@ -4,7 +4,6 @@ import os
 import sys
 import signal
 import optparse
-import math
 
 try:
   import whisper
@@ -50,7 +49,8 @@ option_parser.add_option('--estimate', default=False, action='store_true',
 option_parser.add_option('--sparse', default=False, action='store_true',
                          help="Create new whisper as sparse file")
 option_parser.add_option('--fallocate', default=False, action='store_true',
-                         help="Create new whisper and use fallocate")
+                         help="Create new whisper and use fallocate (the "
+                              "default unless --sparse is given)")
 
 (options, args) = option_parser.parse_args()
 
@@ -69,7 +69,7 @@ if options.estimate:
     total_points += points
 
   size = 16 + (archives * 12) + (total_points * 12)
-  disk_size = int(math.ceil(size / 4096.0) * 4096)
+  disk_size = -(-size // 4096) * 4096  # round up to whole 4k blocks
   print("\nEstimated Whisper DB Size: %s (%s bytes on disk with 4k blocks)\n" %
         (byte_format(size), disk_size))
   for x in [1, 5, 10, 50, 100, 500]:
@@ -92,7 +92,7 @@ if os.path.exists(path) and options.overwrite:
 try:
   whisper.create(path, archives, xFilesFactor=options.xFilesFactor,
                  aggregationMethod=options.aggregationMethod, sparse=options.sparse,
-                 useFallocate=options.fallocate)
+                 useFallocate=options.fallocate or not options.sparse)
 except whisper.WhisperException as exc:
   raise SystemExit('[ERROR] %s' % str(exc))
 
@@ -30,7 +30,7 @@ if len(args) != 2:
   option_parser.print_help()
   sys.exit(1)
 
-(path_a, path_b) = args[0::1]
+(path_a, path_b) = args
 
 if options.until:
   until_time = int(options.until)
@@ -50,13 +50,13 @@ def print_diffs(diffs, pretty=True, headers=True):
   for archive, points, total in diffs:
     if pretty:
       sys.stdout.write('Archive %d (%d of %d datapoints differ)\n' %
-                       (archive, points.__len__(), total))
+                       (archive, len(points), total))
       sys.stdout.write(h % ('', 'timestamp', 'value_a', 'value_b'))
-    for p in points:
-      if pretty:
-        sys.stdout.write(f % ('', p[0], p[1], p[2]))
-      else:
-        sys.stdout.write(f % (archive, p[0], p[1], p[2]))
+      column = ''
+    else:
+      column = archive
+    # one write per archive instead of one per differing point
+    sys.stdout.write(''.join([f % (column, p[0], p[1], p[2]) for p in points]))
 
 
 def print_summary(diffs, pretty=True, headers=True):
@@ -67,32 +67,40 @@ def print_summary(diffs, pretty=True, headers=True):
   if headers:
     sys.stdout.write(f % ('archive', 'total', 'differing'))
   for archive, points, total in diffs:
-    sys.stdout.write(f % (archive, total, points.__len__()))
+    sys.stdout.write(f % (archive, total, len(points)))
+
+
+json_encoder = json.JSONEncoder(sort_keys=True, indent=2, separators=(',', ' : '))
+
+
+def write_json(obj):
+  # stream the encoded chunks rather than building the whole document first
+  for chunk in json_encoder.iterencode(obj):
+    sys.stdout.write(chunk)
+  sys.stdout.write('\n')
 
 
 def print_summary_json(diffs, path_a, path_b):
-  print(json.dumps({'path_a': path_a,
-                    'path_b': path_b,
-                    'archives': [{'archive': archive,
-                                  'total': total,
-                                  'points': points.__len__()}
-                                 for archive, points, total in diffs]},
-                   sort_keys=True, indent=2, separators=(',', ' : ')))
+  write_json({'path_a': path_a,
+              'path_b': path_b,
+              'archives': [{'archive': archive,
+                            'total': total,
+                            'points': len(points)}
+                           for archive, points, total in diffs]})
 
 
 def print_diffs_json(diffs, path_a, path_b):
-  print(json.dumps({'path_a': path_a,
-                    'path_b': path_b,
-                    'archives': [{'archive': archive,
-                                  'total': total,
-                                  'points': points.__len__(),
-                                  'datapoint': [{
-                                      'timestamp': p[0],
-                                      'value_a': p[1],
-                                      'value_b': p[2]
-                                    } for p in points]}
-                                 for archive, points, total in diffs]},
-                   sort_keys=True, indent=2, separators=(',', ' : ')))
+  write_json({'path_a': path_a,
+              'path_b': path_b,
+              'archives': [{'archive': archive,
+                            'total': total,
+                            'points': len(points),
+                            'datapoint': [{
+                                'timestamp': p[0],
+                                'value_a': p[1],
+                                'value_b': p[2]
+                              } for p in points]}
+                           for archive, points, total in diffs]})
 
 
 def main():
@@ -2,6 +2,7 @@
 
 import os
 import mmap
+import errno
 import time
 import struct
 import signal
@@ -19,6 +20,26 @@ if sys.version_info >= (3, 0):
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
+metadataStruct = struct.Struct(whisper.metadataFormat)
+archiveInfoStruct = struct.Struct(whisper.archiveInfoFormat)
+pointStruct = struct.Struct(whisper.pointFormat)
+
+metadataTemplate = '''Meta data:
+  aggregation method: %(aggregationMethod)s
+  max retention: %(maxRetention)d
+  xFilesFactor: %(xFilesFactor)g
+
+'''
+
+archiveInfoTemplate = '''Archive %(index)d info:
+  offset: %(offset)d
+  seconds per point: %(secondsPerPoint)d
+  points: %(points)d
+  retention: %(retention)d
+  size: %(size)d
+
+'''
+
 option_parser = optparse.OptionParser(usage='''%prog path''')
 option_parser.add_option(
   '--pretty', default=False, action='store_true',
@@ -41,25 +62,32 @@ def mmap_file(filename):
   fd = os.open(filename, os.O_RDONLY)
   map = mmap.mmap(fd, os.fstat(fd).st_size, prot=mmap.PROT_READ)
   os.close(fd)
+  # The whole file is about to be read front to back, so ask the kernel to
+  # start reading it in now instead of faulting it in a page at a time
+  # (mmap.madvise needs Python 3.8+)
+  if hasattr(map, 'madvise'):
+    for advice in ('MADV_SEQUENTIAL', 'MADV_WILLNEED'):
+      if hasattr(mmap, advice):
+        map.madvise(getattr(mmap, advice))
   return map
 
 
 def read_header(map):
   try:
     (aggregationType, maxRetention, xFilesFactor, archiveCount) \
-      = struct.unpack(whisper.metadataFormat, map[:whisper.metadataSize])
+      = metadataStruct.unpack_from(map, 0)
   except (struct.error, ValueError, TypeError):
     raise whisper.CorruptWhisperFile("Unable to unpack header")
 
   archives = []
   archiveOffset = whisper.metadataSize
+  unpackArchiveInfo = archiveInfoStruct.unpack_from
+  archiveInfoSize = whisper.archiveInfoSize
+  pointSize = whisper.pointSize
 
   for i in xrange(archiveCount):
     try:
-      (offset, secondsPerPoint, points) = struct.unpack(
-        whisper.archiveInfoFormat,
-        map[archiveOffset:archiveOffset + whisper.archiveInfoSize]
-      )
+      (offset, secondsPerPoint, points) = unpackArchiveInfo(map, archiveOffset)
     except (struct.error, ValueError, TypeError):
       raise whisper.CorruptWhisperFile("Unable to read archive %d metadata" % i)
 
@@ -68,10 +96,10 @@ def read_header(map):
       'secondsPerPoint': secondsPerPoint,
       'points': points,
       'retention': secondsPerPoint * points,
-      'size': points * whisper.pointSize,
+      'size': points * pointSize,
     }
     archives.append(archiveInfo)
-    archiveOffset += whisper.archiveInfoSize
+    archiveOffset += archiveInfoSize
 
   header = {
     'aggregationMethod': whisper.aggregationTypeToMethod.get(aggregationType, 'average'),
@@ -82,56 +110,81 @@ def read_header(map):
   return header
 
 
+def iter_points(map, offset, count):
+  pointSize = whisper.pointSize
+  end = offset + count * pointSize
+  if hasattr(pointStruct, 'iter_unpack'):
+    # a memoryview slice decodes straight from the mapping without copying
+    # the archive into a bytes object first
+    return pointStruct.iter_unpack(memoryview(map)[offset:end])
+  # Python 2 has no iter_unpack
+  unpackPoint = pointStruct.unpack_from
+  return (unpackPoint(map, pointOffset)
+          for pointOffset in xrange(offset, end, pointSize))
+
+
 def dump_header(header):
-  print('Meta data:')
-  print('  aggregation method: %s' % header['aggregationMethod'])
-  print('  max retention: %d' % header['maxRetention'])
-  print('  xFilesFactor: %g' % header['xFilesFactor'])
-  print("")
+  sys.stdout.write(metadataTemplate % header)
   dump_archive_headers(header['archives'])
 
 
 def dump_archive_headers(archives):
-  for i, archive in enumerate(archives):
-    print('Archive %d info:' % i)
-    print('  offset: %d' % archive['offset'])
-    print('  seconds per point: %d' % archive['secondsPerPoint'])
-    print('  points: %d' % archive['points'])
-    print('  retention: %d' % archive['retention'])
-    print('  size: %d' % archive['size'])
-    print("")
+  sys.stdout.write(''.join(archiveInfoTemplate % dict(archive, index=i)
+                           for i, archive in enumerate(archives)))
+
+
+def dump_raw_archives(archives):
+  # Raw lines are plain ASCII, so on Python 3 they skip the text layer and
+  # go straight to the binary stream once the text layer has been flushed
+  stream = getattr(sys.stdout, 'buffer', None)
+  if stream is None:
+    write = sys.stdout.write
+  else:
+    sys.stdout.flush()
+
+    def write(text):
+      stream.write(text.encode('ascii'))
+
+  for archive in archives:
+    # repr() is the shortest string that reads back as the same float
+    points = iter_points(map, archive['offset'], archive['points'])
+    write(''.join(['%s:%r\n' % point for point in points]))
 
 
 def dump_archives(archives, options):
+  if options.raw:
+    dump_raw_archives(archives)
+    return
+
+  # The timestamp format is fixed for the whole dump, pick it once
+  if options.pretty:
+    if options.time_format:
+      def format_time(timestamp):
+        return time.strftime(options.time_format, time.localtime(timestamp))
+    else:
+      format_time = time.ctime
+  else:
+    format_time = str
+
   for i, archive in enumerate(archives):
-    if not options.raw:
-      print('Archive %d data:' % i)
-    offset = archive['offset']
-    for point in xrange(archive['points']):
-      (timestamp, value) = struct.unpack(
-        whisper.pointFormat,
-        map[offset:offset + whisper.pointSize]
-      )
-      if options.pretty:
-        if options.time_format:
-          timestr = time.localtime(timestamp)
-          timestr = time.strftime(options.time_format, timestr)
-        else:
-          timestr = time.ctime(timestamp)
-      else:
-        timestr = str(timestamp)
-      if options.raw:
-        print('%s:%.35g' % (timestamp, value))
-      else:
-        print('%d: %s, %10.35g' % (point, timestr, value))
-      offset += whisper.pointSize
+    # Lines are collected and written once per archive rather than
+    # going through print() for every point
+    lines = ['Archive %d data:' % i]
+    points = iter_points(map, archive['offset'], archive['points'])
+    lines.extend(['%d: %s, %10.35g' % (point, format_time(timestamp), value)
+                  for point, (timestamp, value) in enumerate(points)])
+    lines.append('')
+    sys.stdout.write('\n'.join(lines))
     print
 
 
-if not os.path.exists(path):
+try:
+  map = mmap_file(path)
+except OSError as exc:
+  # report a missing file from the open itself instead of stat-ing first
+  if exc.errno != errno.ENOENT:
+    raise
   raise SystemExit('[ERROR] File "%s" does not exist!' % path)
-
-map = mmap_file(path)
 header = read_header(map)
 if not options.raw:
   dump_header(header)
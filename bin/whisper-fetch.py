@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import sys
+import json
+import itertools
 import time
 import signal
 import optparse
@@ -10,10 +12,12 @@ try:
 except ImportError:
   raise SystemExit('[ERROR] Please make sure whisper is installed properly')
 
+# Each filter runs over the whole series at once so no function call is
+# made per value; for 'empty', None and 0 are exactly the falsy values
 _DROP_FUNCTIONS = {
-    'zeroes': lambda x: x != 0,
-    'nulls': lambda x: x is not None,
-    'empty': lambda x: x != 0 and x is not None
+    'zeroes': lambda values: [x for x in values if x != 0],
+    'nulls': lambda values: [x for x in values if x is not None],
+    'empty': lambda values: [x for x in values if x]
 }
 
 # Ignore SIGPIPE
@@ -65,13 +69,12 @@ except (whisper.WhisperException, IOError) as exc:
   raise SystemExit('[ERROR] %s' % str(exc))
 
 if options.drop:
-  fcn = _DROP_FUNCTIONS.get(options.drop)
-  values = [x for x in values if fcn(x)]
+  values = _DROP_FUNCTIONS[options.drop](values)
 
 (start, end, step) = timeInfo
 
 if options.json:
-  values_json = str(values).replace('None', 'null')
+  values_json = json.dumps(values)
   print('''{
     "start" : %d,
     "end" : %d,
@@ -80,18 +83,15 @@ if options.json:
   }''' % (start, end, step, values_json))
   sys.exit(0)
 
-t = start
-for value in values:
-  if options.pretty:
-    if options.time_format:
-      timestr = time.strftime(options.time_format, time.localtime(t))
-    else:
-      timestr = time.ctime(t)
+if options.pretty:
+  if options.time_format:
+    def format_time(t):
+      return time.strftime(options.time_format, time.localtime(t))
   else:
-    timestr = str(t)
-  if value is None:
-    valuestr = "None"
-  else:
-    valuestr = "%f" % value
-  print("%s\t%s" % (timestr, valuestr))
-  t += step
+    format_time = time.ctime
+else:
+  format_time = str
+
+lines = ["%s\t%s\n" % (format_time(t), "None" if value is None else "%f" % value)
+         for (t, value) in zip(itertools.count(start, step), values)]
+sys.stdout.write(''.join(lines))
@@ -26,11 +26,10 @@ except ImportError:
 import time
 import sys
 import optparse
+import itertools
 
 if sys.version_info >= (3, 0):
     xrange = range
-else:
-    from future_builtins import filter, zip
 
 
 def itemgetter(*items):
@@ -52,71 +51,128 @@ def itemgetter(*items):
 def fill(src, dst, tstart, tstop):
     # fetch range start-stop from src, taking values from the highest
     # precision archive, thus optionally requiring multiple fetch + merges
-    srcHeader = whisper.info(src)
+    fill_ranges(src, dst, [(tstart, tstop)])
 
-    srcArchives = srcHeader['archives']
-    srcArchives.sort(key=itemgetter('retention'))
 
-    # find oldest point in time, stored by both files
-    srcTime = int(time.time()) - srcHeader['maxRetention']
+def fill_ranges(src, dst, gaps, srcHeader=None, now=None):
+    # like fill(), but for a list of (tstart, tstop) gaps at once: every
+    # src archive is fetched a single time for all the gaps it has to fill
+    if srcHeader is None:
+        srcHeader = whisper.info(src)
 
-    if tstart < srcTime and tstop < srcTime:
-        return
+    srcArchives = sorted(srcHeader['archives'], key=itemgetter('retention'))
 
-    # we want to retain as much precision as we can, hence we do backwards
-    # walk in time
+    if now is None:
+        now = time.time()
+    # find oldest point in time, stored by both files
+    srcTime = int(now) - srcHeader['maxRetention']
 
-    # skip forward at max 'step' points at a time
-    for archive in srcArchives:
-        # skip over archives that don't have any data points
-        rtime = time.time() - archive['retention']
-        if tstop <= rtime:
+    # we want to retain as much precision as we can, hence we do backwards
+    # walk in time, collecting the window each archive has to provide
+    windows = []
+    for (tstart, tstop) in gaps:
+        if tstart < srcTime and tstop < srcTime:
             continue
 
-        untilTime = tstop
-        fromTime = rtime if rtime > tstart else tstart
+        for archive in srcArchives:
+            # skip over archives that don't have any data points
+            rtime = now - archive['retention']
+            if tstop <= rtime:
+                continue
 
-        (timeInfo, values) = whisper.fetch(src, fromTime, untilTime)
-        (start, end, archive_step) = timeInfo
-        pointsToWrite = list(filter(
-            lambda points: points[1] is not None,
-            zip(xrange(start, end, archive_step), values)))
-        # order points by timestamp, newest first
-        pointsToWrite.sort(key=lambda p: p[0], reverse=True)
+            fromTime = rtime if rtime > tstart else tstart
+            windows.append((archive, fromTime, tstop))
+            tstop = fromTime
+
+            # can stop when there's nothing to fetch any more
+            if tstart == tstop:
+                break
+
+    # fetch each archive once, covering all of its windows
+    fetched = {}
+    for archive in srcArchives:
+        step = archive['secondsPerPoint']
+        intervals = [fetch_interval(window[1], window[2], step)
+                     for window in windows if window[0] is archive]
+        if intervals:
+            fetched[step] = whisper.fetch(
+                src,
+                min(interval[0] for interval in intervals) - step,
+                max(interval[1] for interval in intervals) - step,
+                archiveToSelect=step)
+
+    # write the windows in the same order as filling gap by gap would, as
+    # windows of different archives may share a point
+    for (archive, fromTime, untilTime) in windows:
+        step = archive['secondsPerPoint']
+        (first, last) = fetch_interval(fromTime, untilTime, step)
+        data = fetched[step]
+        if data is None or first < data[0][0] or last > data[0][1]:
+            # the shared fetch was clipped, fetch this window by itself
+            data = whisper.fetch(src, fromTime, untilTime, archiveToSelect=step)
+            if data is None:
+                continue
+            (first, last) = data[0][:2]
+        ((start, end, step), values) = data
+
+        # newest first, the order update_many writes them in
+        values = values[(first - start) // step:(last - start) // step]
+        values.reverse()
+        pointsToWrite = [point for point in zip(xrange(last - step, first - step, -step), values)
+                         if point[1] is not None]
         whisper.update_many(dst, pointsToWrite)
 
-        tstop = fromTime
 
-        # can stop when there's nothing to fetch any more
-        if tstart == tstop:
-            return
+def fetch_interval(fromTime, untilTime, step):
+    # the [first, last) timestamps whisper.fetch returns for a time range
+    first = int(fromTime) - int(fromTime) % step + step
+    last = int(untilTime) - int(untilTime) % step + step
+    if first == last:
+        # zero-length time range: fetch always includes the next point
+        last += step
+    return (first, last)
+
+
+def find_gaps(timeInfo, values, minGap):
+    # the (tstart, tstop) ranges to fill for the missing (or zero) values
+    # of a fetch result, ignoring single units lost
+    (start, end, step) = timeInfo
+    gaps = []
+    # walk runs of missing values rather than single points
+    index = 0
+    for present, run in itertools.groupby(values, key=bool):
+        runLength = len(list(run))
+        if not present:
+            gapstart = start + index * step
+            gapend = start + (index + runLength) * step
+            if gapend < end:
+                if (gapend - gapstart) > minGap:
+                    gaps.append((gapstart - step, gapend))
+            elif runLength > 1:
+                # the gap runs up to the last point
+                gaps.append((gapstart - step, end - step))
+        index += runLength
+    return gaps
 
 
 def fill_archives(src, dst, startFrom):
     header = whisper.info(dst)
     archives = header['archives']
-    archives = sorted(archives, key=lambda t: t['retention'])
+    archives = sorted(archives, key=itemgetter('retention'))
+
+    srcHeader = whisper.info(src)
+    # use one clock reading so all archive cutoffs agree with each other
+    now = time.time()
 
     for archive in archives:
-        fromTime = time.time() - archive['retention']
+        fromTime = now - archive['retention']
         if fromTime >= startFrom:
             continue
 
         (timeInfo, values) = whisper.fetch(dst, fromTime, startFrom)
-        (start, end, step) = timeInfo
-        gapstart = None
-        for v in values:
-            if not v and not gapstart:
-                gapstart = start
-            elif v and gapstart:
-                # ignore single units lost
-                if (start - gapstart) > archive['secondsPerPoint']:
-                    fill(src, dst, gapstart - step, start)
-                gapstart = None
-            elif gapstart and start == end - step:
-                fill(src, dst, gapstart - step, start)
-
-            start += step
+        gaps = find_gaps(timeInfo, values, archive['secondsPerPoint'])
+
+        fill_ranges(src, dst, gaps, srcHeader, now)
 
         startFrom = fromTime
 
@@ -49,7 +49,8 @@ if field:
   sys.exit(0)
 
 if options.json:
-  print(json.dumps(info, indent=2, separators=(',', ': ')))
+  json.dump(info, sys.stdout, indent=2, separators=(',', ': '))
+  sys.stdout.write('\n')
 else:
   archives = info.pop('archives')
   for key, value in info.items():
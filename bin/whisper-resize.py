@@ -2,8 +2,11 @@
 
 import os
 import sys
+import array
+import struct
 import time
 import bisect
+import shutil
 import signal
 import optparse
 import traceback
@@ -13,11 +16,15 @@ try:
 except ImportError:
   raise SystemExit('[ERROR] Please make sure whisper is installed properly')
 
+if sys.version_info >= (3, 0):
+  xrange = range
+
+# os.replace also overwrites an existing target on Windows (Python 3.3+)
+replace = getattr(os, 'replace', os.rename)
+
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-now = int(time.time())
-
 option_parser = optparse.OptionParser(
     usage='''%prog path timePerPoint:timeToStore [timePerPoint:timeToStore]*
 
@@ -56,7 +63,7 @@ option_parser.add_option(
     type='int', help="Run chown for specific GID")
 option_parser.add_option(
     '--nobackup', action='store_true',
-    help='Delete the .bak file after successful execution')
+    help="Don't keep the old file as a .bak next to the new one")
 option_parser.add_option(
     '--aggregate', action='store_true',
     help='Try to aggregate the values to fit the new archive better.'
@@ -68,175 +75,248 @@ option_parser.add_option(
     '--silent', default=False, action='store_true',
     help='Print no messages')
 
-(options, args) = option_parser.parse_args()
 
-if len(args) < 2:
-  option_parser.print_help()
-  sys.exit(1)
+def fsync_dir(path):
+  # Make renames in the directory of path durable, not just file contents
+  if not hasattr(os, 'O_DIRECTORY'):
+    return
+  try:
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+  except OSError:
+    # not every filesystem supports syncing a directory
+    pass
+
+
+def backup_file(path, backup):
+  # A hard link keeps the old file under both names, so path itself never
+  # goes missing; copy it where links aren't available
+  if os.path.lexists(backup):
+    os.unlink(backup)
+  try:
+    os.link(path, backup)
+  except (OSError, AttributeError):
+    shutil.copy2(path, backup)
 
-path = args[0]
 
-if not os.path.exists(path):
-  sys.stderr.write("[ERROR] File '%s' does not exist!\n\n" % path)
-  option_parser.print_help()
-  sys.exit(1)
+def main(argv=None, info=None):
+  (options, args) = option_parser.parse_args(argv)
 
-if not options.silent:
-    size = os.stat(path).st_size
-    blocks = os.stat(path).st_blocks
-    print('Old file: %s (%d bytes, %d blocks*%d=%d bytes on disk)'
-          % (path, size, blocks, 512, blocks * 512))
+  now = int(time.time())
 
-info = whisper.info(path)
+  if len(args) < 2:
+    option_parser.print_help()
+    sys.exit(1)
 
-new_archives = [whisper.parseRetentionDef(retentionDef)
-                for retentionDef in args[1:]]
+  path = args[0]
 
-old_archives = info['archives']
-# sort by precision, lowest to highest
-old_archives.sort(key=lambda a: a['secondsPerPoint'], reverse=True)
+  if not os.path.exists(path):
+    sys.stderr.write("[ERROR] File '%s' does not exist!\n\n" % path)
+    option_parser.print_help()
+    sys.exit(1)
 
-if options.xFilesFactor is None:
-  xff = info['xFilesFactor']
-else:
-  xff = options.xFilesFactor
+  if not options.silent:
+      st = os.stat(path)
+      print('Old file: %s (%d bytes, %d blocks*%d=%d bytes on disk)'
+            % (path, st.st_size, st.st_blocks, 512, st.st_blocks * 512))
 
-if options.aggregationMethod is None:
-  aggregationMethod = info['aggregationMethod']
-else:
-  aggregationMethod = options.aggregationMethod
+  # callers that already read the header can hand it in
+  if info is None:
+    info = whisper.info(path)
 
-if not options.quiet and not options.silent:
-    print('Retrieving all data from the archives')
-for archive in old_archives:
-  fromTime = now - archive['retention'] + archive['secondsPerPoint']
-  untilTime = now
-  timeinfo, values = whisper.fetch(path, fromTime, untilTime)
-  archive['data'] = (timeinfo, values)
+  new_archives = [whisper.parseRetentionDef(retentionDef)
+                  for retentionDef in args[1:]]
 
-if options.newfile is None:
-  tmpfile = path + '.tmp'
-  if os.path.exists(tmpfile):
-    if not options.quiet and not options.silent:
-        print('Removing previous temporary database file: %s' % tmpfile)
-    os.unlink(tmpfile)
-  newfile = tmpfile
-else:
-  newfile = options.newfile
+  old_archives = info['archives']
+  # sort by precision, lowest to highest
+  old_archives.sort(key=lambda a: a['secondsPerPoint'], reverse=True)
 
-if not options.quiet and not options.silent:
-    print('Creating new whisper database: %s' % newfile)
+  if options.xFilesFactor is None:
+    xff = info['xFilesFactor']
+  else:
+    xff = options.xFilesFactor
 
-try:
-    whisper.create(newfile, new_archives, xFilesFactor=xff,
-                   aggregationMethod=aggregationMethod, sparse=options.sparse,
-                   useFallocate=options.fallocate)
-except whisper.WhisperException as exc:
-    raise SystemExit('[ERROR] %s' % str(exc))
-
-size = os.stat(newfile).st_size
-blocks = os.stat(newfile).st_blocks
-if not options.quiet and not options.silent:
-    print('Created: %s (%d bytes, %d blocks*%d=%d bytes on disk)'
-          % (newfile, size, blocks, 512, blocks * 512))
-
-if options.aggregate:
-  # This is where data will be interpolated (best effort)
-  if not options.quiet and not options.silent:
-    print('Migrating data with aggregation...')
-  all_datapoints = []
-  for archive in sorted(old_archives, key=lambda x: x['secondsPerPoint']):
-    # Loading all datapoints into memory for fast querying
-    timeinfo, values = archive['data']
-    new_datapoints = list(zip(range(*timeinfo), values))
-    new_datapoints.reverse()
-    if all_datapoints:
-      last_timestamp = all_datapoints[-1][0]
-      slice_end = 0
-      for i, (timestamp, value) in enumerate(new_datapoints):
-        if timestamp < last_timestamp:
-          slice_end = i
-          break
-      all_datapoints += new_datapoints[slice_end:]
-    else:
-      all_datapoints += new_datapoints
-  all_datapoints.reverse()
-
-  oldtimestamps = list(map(lambda p: p[0], all_datapoints))
-  oldvalues = list(map(lambda p: p[1], all_datapoints))
-  if not options.quiet and not options.silent:
-    print("oldtimestamps: %s" % oldtimestamps)
-  # Simply cleaning up some used memory
-  del all_datapoints
-
-  new_info = whisper.info(newfile)
-  new_archives = new_info['archives']
+  if options.aggregationMethod is None:
+    aggregationMethod = info['aggregationMethod']
+  else:
+    aggregationMethod = options.aggregationMethod
 
-  for archive in new_archives:
-    step = archive['secondsPerPoint']
-    fromTime = now - archive['retention'] + now % step
-    untilTime = now + now % step + step
-    if not options.quiet and not options.silent:
-      print("(%s,%s,%s)" % (fromTime, untilTime, step))
-    timepoints_to_update = range(fromTime, untilTime, step)
+  # Rewriting a file into the very same layout only costs I/O, unless a
+  # copy, a preallocated file or a chown was explicitly asked for
+  chown = options.chown_uid > 0 and options.chown_gid > 0
+  if options.newfile is None and not options.fallocate and not chown and \
+     sorted((a['secondsPerPoint'], a['points']) for a in old_archives) == \
+     sorted(new_archives) and \
+     struct.pack('!f', xff) == struct.pack('!f', info['xFilesFactor']) and \
+     aggregationMethod == info['aggregationMethod']:
     if not options.quiet and not options.silent:
-      print("timepoints_to_update: %s" % timepoints_to_update)
-    newdatapoints = []
-    for tinterval in zip(timepoints_to_update[:-1], timepoints_to_update[1:]):
-      # TODO: Setting lo= parameter for 'lefti' based on righti from previous
-      #       iteration. Obviously, this can only be done if
-      #       timepoints_to_update is always updated. Is it?
-      lefti = bisect.bisect_left(oldtimestamps, tinterval[0])
-      righti = bisect.bisect_left(oldtimestamps, tinterval[1], lo=lefti)
-      newvalues = oldvalues[lefti:righti]
-      if newvalues:
-        non_none = list(filter(lambda x: x is not None, newvalues))
-        if non_none and 1.0 * len(non_none) / len(newvalues) >= xff:
-          newdatapoints.append([tinterval[0],
-                                whisper.aggregate(aggregationMethod,
-                                                  non_none, newvalues)])
-    whisper.update_many(newfile, newdatapoints)
-else:
+      print('No change, skipping: %s' % path)
+    return
+
   if not options.quiet and not options.silent:
-    print('Migrating data without aggregation...')
+      print('Retrieving all data from the archives')
   for archive in old_archives:
-    timeinfo, values = archive['data']
-    datapoints = zip(range(*timeinfo), values)
-    datapoints = filter(lambda p: p[1] is not None, datapoints)
-    whisper.update_many(newfile, datapoints)
+    fromTime = now - archive['retention'] + archive['secondsPerPoint']
+    untilTime = now
+    timeinfo, values = whisper.fetch(path, fromTime, untilTime)
+    archive['data'] = (timeinfo, values)
+
+  if options.newfile is None:
+    tmpfile = path + '.tmp'
+    if os.path.exists(tmpfile):
+      if not options.quiet and not options.silent:
+          print('Removing previous temporary database file: %s' % tmpfile)
+      os.unlink(tmpfile)
+    newfile = tmpfile
+  else:
+    newfile = options.newfile
 
-if options.newfile is not None:
-  sys.exit(0)
+  if not options.quiet and not options.silent:
+      print('Creating new whisper database: %s' % newfile)
 
-backup = path + '.bak'
-if not options.quiet and not options.silent:
-    print('Renaming old database to: %s' % backup)
-os.rename(path, backup)
+  try:
+      whisper.create(newfile, new_archives, xFilesFactor=xff,
+                     aggregationMethod=aggregationMethod, sparse=options.sparse,
+                     useFallocate=options.fallocate)
+  except whisper.WhisperException as exc:
+      raise SystemExit('[ERROR] %s' % str(exc))
 
-try:
-  if not options.quiet and not options.silent:
-    print('Renaming new database to: %s' % path)
-  os.rename(tmpfile, path)
-except (OSError):
-  traceback.print_exc()
   if not options.quiet and not options.silent:
-    print('\nOperation failed, restoring backup')
-  os.rename(backup, path)
-  sys.exit(1)
+      st = os.stat(newfile)
+      print('Created: %s (%d bytes, %d blocks*%d=%d bytes on disk)'
+            % (newfile, st.st_size, st.st_blocks, 512, st.st_blocks * 512))
+
+  # Keep the new file open for the whole migration rather than reopening
+  # it for every archive handed to update_many
+  with open(newfile, 'r+b', whisper.BUFFERING) as fh:
+    if options.aggregate:
+      # This is where data will be interpolated (best effort)
+      if not options.quiet and not options.silent:
+        print('Migrating data with aggregation...')
+      # Loading all datapoints into memory for fast querying: each archive
+      # provides the points older than the ones of the finer archives
+      slices = []
+      cutoff = None
+      for archive in sorted(old_archives, key=lambda x: x['secondsPerPoint']):
+        (start, end, step), values = archive['data']
+        count = len(values)
+        if cutoff is not None:
+          count = min(count, max(0, (cutoff - start + step - 1) // step))
+        if count:
+          slices.append((start, step, values[:count]))
+          cutoff = start
+
+      # timestamps are unsigned 32-bit on disk, keep them unboxed as such
+      oldtimestamps = array.array('L')
+      oldvalues = []
+      for (start, step, values) in reversed(slices):
+        oldtimestamps.extend(xrange(start, start + len(values) * step, step))
+        oldvalues.extend(values)
+      oldcount = len(oldtimestamps)
+      # knownCounts[i] is how many of oldvalues[:i] are known, so the share
+      # of known values in any interval takes two lookups to find
+      knownCounts = array.array('L', [0])
+      known = 0
+      for value in oldvalues:
+        if value is not None:
+          known += 1
+        knownCounts.append(known)
+      minOldStep = min(archive['secondsPerPoint'] for archive in old_archives)
+      if not options.quiet and not options.silent:
+        print("oldtimestamps: %d points" % oldcount)
+      # Simply cleaning up some used memory
+      del slices
+
+      new_info = whisper.info(newfile)
+      new_archives = new_info['archives']
+
+      for archive in new_archives:
+        step = archive['secondsPerPoint']
+        offset = now % step
+        fromTime = now - archive['retention'] + offset
+        untilTime = now + offset + step
+        if not options.quiet and not options.silent:
+          print("(%s,%s,%s)" % (fromTime, untilTime, step))
+        timepoints_to_update = xrange(fromTime, untilTime, step)
+        if not options.quiet and not options.silent:
+          print("timepoints_to_update: %d points" % len(timepoints_to_update))
+        newdatapoints = []
+        # the intervals are contiguous, so each one starts where the
+        # previous one ended and only its end needs to be searched for
+        bisect_left = bisect.bisect_left
+        aggregate = whisper.aggregate
+        # old points are at least minOldStep apart, so an interval holds at
+        # most this many of them and the search can be kept that narrow
+        maxPoints = step // minOldStep + 1
+        righti = bisect_left(oldtimestamps, fromTime)
+        for intervalEnd in xrange(fromTime + step, untilTime, step):
+          lefti = righti
+          righti = bisect_left(oldtimestamps, intervalEnd, lefti,
+                               min(lefti + maxPoints, oldcount))
+          if righti == lefti:
+            continue
+          known = knownCounts[righti] - knownCounts[lefti]
+          if known and 1.0 * known / (righti - lefti) >= xff:
+            newvalues = oldvalues[lefti:righti]
+            if known == len(newvalues):
+              non_none = newvalues
+            else:
+              non_none = [v for v in newvalues if v is not None]
+            newdatapoints.append([intervalEnd - step,
+                                  aggregate(aggregationMethod, non_none, newvalues)])
+        if newdatapoints:
+          newdatapoints.reverse()  # file_update_many expects the newest points first
+          whisper.file_update_many(fh, newdatapoints)
+    else:
+      if not options.quiet and not options.silent:
+        print('Migrating data without aggregation...')
+      for archive in old_archives:
+        timeinfo, values = archive['data']
+        datapoints = [point for point in zip(xrange(*timeinfo), values)
+                      if point[1] is not None]
+        if datapoints:
+          datapoints.reverse()  # file_update_many expects the newest points first
+          whisper.file_update_many(fh, datapoints)
+
+    # the data has to be on disk before the file is swapped in below
+    fh.flush()
+    os.fsync(fh.fileno())
+
+  if options.newfile is not None:
+    sys.exit(0)
+
+  if not options.nobackup:
+    backup = path + '.bak'
+    if not options.quiet and not options.silent:
+        print('Backing up old database to: %s' % backup)
+    backup_file(path, backup)
 
-if options.chown_uid > 0 and options.chown_gid > 0:
   try:
-    os.chown(path=path, uid=options.chown_uid, gid=options.chown_gid)
+    if not options.quiet and not options.silent:
+      print('Renaming new database to: %s' % path)
+    # a single rename over the old file, so path always names one of them
+    replace(tmpfile, path)
   except (OSError):
     traceback.print_exc()
+    if not options.quiet and not options.silent:
+      print('\nOperation failed, old database left in place')
+    sys.exit(1)
+  fsync_dir(path)
 
-if not options.silent:
-    size = os.stat(path).st_size
-    blocks = os.stat(path).st_blocks
-    print('New file: %s (%d bytes, %d blocks*%d=%d bytes on disk)'
-          % (path, size, blocks, 512, blocks * 512))
+  if chown:
+    try:
+      os.chown(path=path, uid=options.chown_uid, gid=options.chown_gid)
+    except (OSError):
+      traceback.print_exc()
 
-if options.nobackup:
-  if not options.quiet and not options.silent:
-    print("Unlinking backup: %s" % backup)
-  os.unlink(backup)
+  if not options.silent:
+      st = os.stat(path)
+      print('New file: %s (%d bytes, %d blocks*%d=%d bytes on disk)'
+            % (path, st.st_size, st.st_blocks, 512, st.st_blocks * 512))
+
+
+if __name__ == '__main__':
+  main()
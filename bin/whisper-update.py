@@ -4,6 +4,7 @@ import sys
 import time
 import signal
 import optparse
+import itertools
 
 try:
   import whisper
@@ -15,6 +16,14 @@ signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 now = int(time.time())
 
+# Maximum number of datapoints handed to whisper.update_many at once. One
+# call settles the points sharing an archive interval by their timestamps,
+# but a later chunk simply overwrites what an earlier one wrote, so unsorted
+# input larger than one chunk, or a timestamp repeated in different chunks,
+# can be stored differently than by a single call. Time-ordered input
+# without repeated timestamps is stored the same.
+UPDATE_CHUNK_SIZE = 10000
+
 option_parser = optparse.OptionParser(
   usage='''%prog [options] path [timestamp:value]*
 
@@ -32,15 +41,20 @@ if len(args) >= 2:
 else:
   # no argv values, so read from stdin
   datapoint_strings = sys.stdin
-datapoint_strings = [point.replace('N:', '%d:' % now)
-                     for point in datapoint_strings]
-datapoints = [tuple(point.split(':')) for point in datapoint_strings]
+# Points are parsed lazily while chunks are taken off the generator, so
+# a long stream on stdin is never held in memory as a whole
+now_prefix = '%d:' % now
+datapoints = ((now_prefix + point[2:] if point.startswith('N:') else point).split(':', 1)
+              for point in datapoint_strings)
 
 try:
-  if len(datapoints) == 1:
-    timestamp, value = datapoints[0]
+  chunk = list(itertools.islice(datapoints, UPDATE_CHUNK_SIZE))
+  if len(chunk) == 1:
+    timestamp, value = chunk[0]
     whisper.update(path, value, timestamp)
   else:
-    whisper.update_many(path, datapoints)
+    while chunk:
+      whisper.update_many(path, chunk)
+      chunk = list(itertools.islice(datapoints, UPDATE_CHUNK_SIZE))
 except whisper.WhisperException as exc:
   raise SystemExit('[ERROR] %s' % str(exc))
@@ -13,23 +13,37 @@ import subprocess
 import argparse
 import re
 import time
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, Semaphore, cpu_count
 from configobj import ConfigObj
-# Assuming Python 2, we'll want scandir if possible, it's much faster
 try:
-    from scandir import scandir
+    import whisper
+except ImportError:
+    raise SystemExit('[ERROR] Please make sure whisper is installed properly')
+try:
+    from os import scandir
 except ImportError:
-    from os import listdir as scandir
+    # Assuming Python 2, we'll want the scandir backport, it's much faster
+    from scandir import scandir
 
 LOG = logging.getLogger()
 LOG.setLevel(logging.INFO)
 SCHEMA_LIST = {}
 # The very basic default retentions
 DEFAULT_SCHEMA = {'match': re.compile('.*'),
-                  'retentions': '1m:7d'}
+                  'retentions': ['1m:7d'],
+                  'parsed_retentions': [604800]}
+# All of SCHEMA_LIST as one regex, group sN matching SCHEMA_INFO[N]
+SCHEMA_MATCH = None
+SCHEMA_INFO = []
 DEBUG = False
 DRY_RUN = False
 ROOT_PATH = ""
+MAX_RESIZES = cpu_count()
+SLEEP_RATIO = None
+# Shared by all workers, caps how many resizes write at the same time
+RESIZE_SEMAPHORE = None
+# whisper-resize.py loaded as a module, None to run it as a command
+WHISPER_RESIZE = None
 
 
 def config_schemas(cfg):
@@ -37,13 +51,63 @@ def config_schemas(cfg):
 
     for schema in schema_conf.items():
         item = schema[1]['pattern']
+        retentions = _split_retentions(schema[1]['retentions'])
         if item == '.*':
-            DEFAULT_SCHEMA['retentions'] = schema[1]['retentions']
+            DEFAULT_SCHEMA['retentions'] = retentions
+            DEFAULT_SCHEMA['parsed_retentions'] = _parse_retentions(retentions)
         else:
             if item[0] == '^':
                 item = item[1:]
-            SCHEMA_LIST[item] = {'retentions': schema[1]['retentions'],
+            SCHEMA_LIST[item] = {'retentions': retentions,
+                                 'parsed_retentions': _parse_retentions(retentions),
                                  'match': re.compile(item)}
+    _combine_schemas()
+
+
+# ConfigObj hands back a bare string when a schema has a single retention
+def _split_retentions(retentions):
+    if not isinstance(retentions, list):
+        return [retentions]
+    return retentions
+
+
+# Parsed once per schema here rather than once per metric in fix_metric
+def _parse_retentions(retentions):
+    return [_convert_seconds(item) for item in retentions]
+
+
+# Join SCHEMA_LIST into SCHEMA_MATCH, which _find_schema tries first. Left
+# unset if any pattern uses backreferences or inline flags
+def _combine_schemas():
+    global SCHEMA_MATCH, SCHEMA_INFO
+    SCHEMA_MATCH = None
+    SCHEMA_INFO = []
+    patterns = []
+    for i, (item, info) in enumerate(SCHEMA_LIST.items()):
+        if info['match'].flags != re.compile('').flags or \
+                re.search(r'\\[1-9]|\(\?P=', item):
+            SCHEMA_INFO = []
+            return
+        patterns.append('(?P<s%d>(?=.*?(?:%s)))' % (i, item))
+        SCHEMA_INFO.append(info)
+    try:
+        SCHEMA_MATCH = re.compile('(?:%s)' % '|'.join(patterns))
+    except re.error:
+        SCHEMA_INFO = []
+
+
+# The first schema in SCHEMA_LIST whose pattern is found in the metric name,
+# or DEFAULT_SCHEMA
+def _find_schema(matching):
+    if SCHEMA_MATCH is not None:
+        match = SCHEMA_MATCH.match(matching)
+        if match:
+            return SCHEMA_INFO[int(match.lastgroup[1:])]
+        return DEFAULT_SCHEMA
+    for schema, info in SCHEMA_LIST.items():
+        if info['match'].search(matching):
+            return info
+    return DEFAULT_SCHEMA
 
 
 def _convert_seconds(time):
@@ -55,27 +119,74 @@ def _convert_seconds(time):
     return time
 
 
-def _compare_retention(retention, tmp_path):
-    # Get the new retention as [(secondsPerPoint, numPoints), ...]
-    new_retention = [_convert_seconds(item) for item in list(retention)]
-    info_string = [INFO_BIN, tmp_path]
-    cur_ret_list = subprocess.Popen(info_string, stdout=subprocess.PIPE)
-    cur_ret_list = cur_ret_list.communicate()[0].split('\n')
-    cur_retention = [int(line.split(':')[1]) for line in cur_ret_list
-                     if 'retention' in line]
+def _compare_retention(new_retention, tmp_path):
+    # Read the header in-process rather than forking whisper-info.py
+    try:
+        info = whisper.info(tmp_path)
+    except whisper.WhisperException as exc:
+        LOG.error('Failed to read %s: %s' % (tmp_path, exc))
+        return False
+    cur_retention = [archive['retention'] for archive in info['archives']]
     return cur_retention == new_retention
 
 
+# whisper-resize.py as a module to call in-process, or None if it won't load
+def _load_whisper_resize(path):
+    try:
+        try:
+            from importlib.machinery import SourceFileLoader
+            from importlib.util import module_from_spec, spec_from_loader
+        except ImportError:
+            import imp
+            module = imp.load_source('whisper_resize', path)
+        else:
+            loader = SourceFileLoader('whisper_resize', path)
+            module = module_from_spec(spec_from_loader('whisper_resize', loader))
+            loader.exec_module(module)
+    except (IOError, OSError, ImportError, SyntaxError):
+        return None
+    if not hasattr(module, 'main'):
+        return None
+    module.option_parser.prog = os.path.basename(path)
+    return module
+
+
+def _run_resize(metric, command_string, devnull):
+    if WHISPER_RESIZE is None:
+        if DEBUG:
+            return subprocess.check_call(command_string)
+        return subprocess.check_call(command_string, stdout=devnull)
+
+    # Resize in-process, sparing an interpreter start-up per metric
+    stdout = sys.stdout
+    if not DEBUG:
+        sys.stdout = devnull
+    try:
+        WHISPER_RESIZE.main(command_string[1:])
+    except SystemExit as exc:
+        if exc.code is None:
+            return 0
+        if isinstance(exc.code, int):
+            return exc.code
+        LOG.error(exc.code)
+        return 1
+    except Exception:
+        LOG.exception('whisper-resize.py failed for %s' % metric)
+        return 1
+    finally:
+        sys.stdout = stdout
+    return 0
+
+
 def _find_metrics(path):
     for f in scandir(path):
-        if f.is_dir(follow_symlinks=False):
+        # Check the name first, most entries are metrics and telling a
+        # file from a directory may cost a stat
+        if f.name.endswith('.wsp') and f.is_file(follow_symlinks=False):
+            yield f.path
+        elif f.is_dir(follow_symlinks=False):
             for sf in _find_metrics(f.path):
                 yield sf
-        else:
-            if not f.is_file(follow_symlinks=False) or \
-              not f.name.endswith('.wsp'):
-                continue
-            yield f.path
 
 
 def fix_metric(metric):
@@ -88,37 +199,37 @@ def fix_metric(metric):
     devnull = open(os.devnull, 'w')
     command_string = list(BASE_COMMAND) + [metric]
 
-    retention = DEFAULT_SCHEMA['retentions']
-    matching = metric[len(ROOT_PATH):].replace('/', '.')
-    for schema, info in SCHEMA_LIST.iteritems():
-        if info['match'].search(matching):
-            retention = info['retentions']
-            break
-    command_string.extend(list(retention))
+    schema_info = _find_schema(metric[len(ROOT_PATH):].replace('/', '.'))
+    retention = schema_info['retentions']
+    command_string.extend(retention)
     if DEBUG:
         LOG.info("Created command: %s" % command_string)
 
-    if _compare_retention(retention, metric):
+    if _compare_retention(schema_info['parsed_retentions'], metric):
         LOG.debug('%s has the same retention as before!' % metric)
         return [(False, metric)]
 
+    elapsed = 0
     if DRY_RUN:
         res = 0
     else:
         LOG.debug('Retention will be %s' % retention)
         # record file owner/group and perms to set properly after whisper-resize.py is complete
         st = os.stat(metric)
-        if DEBUG:
-            res = subprocess.check_call(command_string)
-        else:
-            res = subprocess.check_call(command_string,
-                                        stdout=devnull)
+        with RESIZE_SEMAPHORE:
+            started = time.time()
+            res = _run_resize(metric, command_string, devnull)
+            elapsed = time.time() - started
         os.chmod(metric, st.st_mode)
         os.chown(metric, st.st_uid, st.st_gid)
 
     devnull.close()
     # wait for a second, so we don't kill I/O on the host
-    time.sleep(SLEEP)
+    if SLEEP_RATIO is None:
+        time.sleep(SLEEP)
+    else:
+        # or for as long as the resize took, scaled, but never longer
+        time.sleep(min(SLEEP, elapsed * SLEEP_RATIO))
     """
     We have manual commands for every failed file from these
     errors, so we can just go through each of these errors
@@ -133,16 +244,23 @@ def fix_metric(metric):
         return [(True, metric)]
 
 
+def _init_worker(resize_semaphore):
+    global RESIZE_SEMAPHORE
+    RESIZE_SEMAPHORE = resize_semaphore
+
+
 def search_and_fix(subdir):
     if not SCHEMA_LIST:
         LOG.error("Didn't initialize schemas!")
         return
 
     fpath = os.path.join(ROOT_PATH, subdir)
-    pool = Pool(cpu_count())
+    pool = Pool(cpu_count(), _init_worker, (Semaphore(MAX_RESIZES),))
     LOG.info('Creating new storage schemas for metrics under %s ...' % fpath)
 
-    results = pool.map(fix_metric, _find_metrics(fpath), 100)
+    # Hand out metrics while the tree is still being walked, and collect
+    # them in whatever order they finish in
+    results = list(pool.imap_unordered(fix_metric, _find_metrics(fpath), 32))
     pool.close()
     pool.join()
     return results
@@ -173,11 +291,22 @@ def cli_opts():
                         help="Passed through to whisper-resize.py, roll up values",
                         default=False)
     parser.add_argument('--bindir', action='store', dest='bindir',
-                        help="The root path to whisper-resize.py and whisper-info.py",
+                        help="The root path to whisper-resize.py",
                         default='/opt/graphite/bin')
     parser.add_argument('--sleep', action='store', type=float, dest='sleep',
                         help="Sleep this amount of time in seconds between metric comparisons",
                         default=0.3)
+    parser.add_argument('--spawn', action='store_true', dest='spawn',
+                        help="Run whisper-resize.py as a separate process for every metric "
+                             "rather than loading it once",
+                        default=False)
+    parser.add_argument('--sleep-ratio', action='store', type=float, dest='sleep_ratio',
+                        help="Instead of always sleeping --sleep seconds, sleep this many "
+                             "times as long as the resize took, up to --sleep",
+                        default=None)
+    parser.add_argument('--max-resizes', action='store', type=int, dest='max_resizes',
+                        help="How many whisper-resize.py runs may write at the same time",
+                        default=cpu_count())
     return parser.parse_args()
 
 
@@ -197,9 +326,12 @@ if __name__ == '__main__':
     DRY_RUN = i_args.dry_run
     BINDIR = i_args.bindir
     SLEEP = i_args.sleep
+    SLEEP_RATIO = i_args.sleep_ratio
+    MAX_RESIZES = i_args.max_resizes
     RESIZE_BIN = BINDIR + "/whisper-resize.py"
-    INFO_BIN = BINDIR + "/whisper-info.py"
     BASE_COMMAND = [RESIZE_BIN]
+    if not i_args.spawn:
+        WHISPER_RESIZE = _load_whisper_resize(RESIZE_BIN)
 
     if i_args.nobackup:
         BASE_COMMAND.append('--nobackup')
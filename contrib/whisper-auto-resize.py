@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 import sys
 import os
-import fnmatch
+import re
 import shlex
+import struct
+import multiprocessing
+import threading
+import traceback
 from subprocess import call
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from distutils.spawn import find_executable
 from os.path import basename
 from six.moves import input
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # On Debian systems whisper-resize.py is available as whisper-resize
 whisperResizeExecutable = find_executable("whisper-resize.py")
 if whisperResizeExecutable is None:
@@ -17,6 +30,37 @@ if whisperResizeExecutable is None:
         # Probably will fail later, set it nevertheless
         whisperResizeExecutable = "whisper-resize.py"
 
+
+def loadWhisperResize(scriptPath):
+    """
+        load the whisper-resize script as a module so it can be run in-process
+
+        Parameters:
+            scriptPath - path to the whisper-resize script
+
+        Returns the module, or None if it can't be loaded
+    """
+    try:
+        try:
+            from importlib.machinery import SourceFileLoader
+            from importlib.util import module_from_spec, spec_from_loader
+        except ImportError:
+            import imp
+            module = imp.load_source('whisper_resize', scriptPath)
+        else:
+            # the script may not have a .py suffix, so name the loader explicitly
+            loader = SourceFileLoader('whisper_resize', scriptPath)
+            module = module_from_spec(spec_from_loader('whisper_resize', loader))
+            loader.exec_module(module)
+    except (IOError, OSError, ImportError, SyntaxError):
+        return None
+    if not hasattr(module, 'main'):
+        return None
+    # usage and errors should name the resize script, not this one
+    module.option_parser.prog = basename(scriptPath)
+    return module
+
+
 option_parser = OptionParser(
     usage='''%prog storagePath configPath
 
@@ -47,6 +91,14 @@ option_parser.add_option(
     '-x', '--extra_args', default='', type='string',
     help="pass any additional arguments to the %s script" %
          basename(whisperResizeExecutable))
+option_parser.add_option(
+    '--spawn', default=False, action='store_true',
+    help="run %s as a separate process for every resize instead of "
+         "calling it in-process" % basename(whisperResizeExecutable))
+option_parser.add_option(
+    '-j', '--jobs', default=2 * multiprocessing.cpu_count(), type='int',
+    help="number of metrics to check at once (default: %default), "
+         "1 checks them one at a time")
 
 (options, args) = option_parser.parse_args()
 
@@ -54,6 +106,12 @@ if len(args) < 2:
     option_parser.print_help()
     sys.exit(1)
 
+if options.jobs < 1:
+    option_parser.error('--jobs must be at least 1')
+
+# the same for every resize, so only split once
+extraArgs = shlex.split(options.extra_args)
+
 storagePath = args[0]
 configPath = args[1]
 
@@ -90,27 +148,157 @@ except ImportError:
 settings.CONF_DIR = configPath
 settings.LOCAL_DATA_DIR = storagePath
 
+# stripped from every whisper file path to get its metric name. normpath
+# sanitizes the directory since we may get a trailing slash or not, and if
+# we don't it creates a leading '.'
+dataDirPrefix = os.path.normpath(settings.LOCAL_DATA_DIR) + os.sep
+
 # import these once we have the settings figured out
 from carbon.storage import loadStorageSchemas, loadAggregationSchemas
+from carbon.storage import DefaultSchema, PatternSchema
 
 # Load the Defined Schemas from our config files
 schemas = loadStorageSchemas()
 agg_schemas = loadAggregationSchemas()
 
+# resizes run inside this process unless asked otherwise, or if the resize
+# script can't be loaded
+whisperResize = None
+if options.spawn is not True:
+    whisperResize = loadWhisperResize(whisperResizeExecutable)
+
+# a bad --extra_args would otherwise only surface at the first resize, after
+# part of the tree has been checked, so let the resize options reject it now
+if whisperResize is not None:
+    whisperResize.option_parser.parse_args(extraArgs)
+
+# metrics are checked by a pool of threads so the whisper.info reads overlap,
+# but only a few whisper-resize processes are allowed to run at any time
+resizeSemaphore = threading.Semaphore(multiprocessing.cpu_count())
+outputLock = threading.Lock()
+
+
+def schemaFinder(schemaList):
+    """
+        build a function that finds the schema carbon would use for a metric,
+        the first one in schemaList that matches it
+
+        When every schema is a plain pattern, or the catch-all default, the
+        patterns are joined into a single regex so each metric is matched
+        once instead of once per schema. Every pattern sits in a lookahead
+        from the start of the name, so an earlier schema still wins wherever
+        in the name it matches. Anything that won't combine that way, like
+        backreferences or flags, keeps the plain loop.
+
+        Parameters:
+            schemaList - carbon schemas, in the order carbon checks them
+
+        Returns a function taking a graphite metric name
+    """
+    def findSchema(metric):
+        # like carbon, fall through to the last schema if nothing matches
+        for schema in schemaList:
+            if schema.matches(metric):
+                break
+        return schema
+
+    patterns = []
+    for i, schema in enumerate(schemaList):
+        if type(schema) is DefaultSchema:
+            patterns.append('(?P<s%d>)' % i)
+        elif type(schema) is PatternSchema and \
+                schema.regex.flags == re.compile('').flags and \
+                not re.search(r'\\[1-9]|\(\?P=', schema.regex.pattern):
+            patterns.append('(?P<s%d>(?=.*?(?:%s)))' % (i, schema.regex.pattern))
+        else:
+            return findSchema
+    if not patterns:
+        return findSchema
+    try:
+        combined = re.compile('(?:%s)' % '|'.join(patterns))
+    except re.error:
+        return findSchema
+
+    def findCombinedSchema(metric):
+        match = combined.match(metric)
+        if match is None:
+            return schemaList[-1]
+        return schemaList[int(match.lastgroup[1:])]
+    return findCombinedSchema
+
+
+findStorageSchema = schemaFinder(schemas)
+findAggregationSchema = schemaFinder(agg_schemas)
+
+
+def schemaSettings(schema, agg_schema):
+    """
+        work out the settings a storage schema and an aggregation schema
+        give a metric
+
+        Parameters:
+            schema     - carbon storage schema
+            agg_schema - carbon storage aggregation schema
+
+        Returns a tuple of ((secondsPerPoint, points) per archive, retentions
+        string, xFilesFactor, xFilesFactor as stored in a whisper header,
+        aggregationMethod)
+    """
+    xFilesFactor, aggregationMethod = agg_schema.archives
+
+    if xFilesFactor is None:
+        xFilesFactor = 0.5
+    if aggregationMethod is None:
+        aggregationMethod = 'average'
+
+    retentions = tuple(archive.getTuple() for archive in schema.archives)
+    # convert the bucket tuples to string format for resizing
+    schema_config_args = ''.join('%s:%s ' % retention for retention in retentions)
+
+    # whisper keeps xFilesFactor as a 32 bit float, so this is exactly what
+    # whisper.info reads back from a file created with it
+    storedXFilesFactor = struct.unpack('!f', struct.pack('!f', float(xFilesFactor)))[0]
+
+    return (retentions, schema_config_args, xFilesFactor, storedXFilesFactor,
+            aggregationMethod)
+
+
+# settings for every (storage schema, aggregation schema) pair. There are only
+# a handful of each, so all of them are worked out up front and the worker
+# threads just read the table.
+resolvedSchemas = dict(((schema, agg_schema), schemaSettings(schema, agg_schema))
+                       for schema in schemas for agg_schema in agg_schemas)
+
+
+def resolveSchemas(metric):
+    """
+        find the configured retentions, xFilesFactor and aggregationMethod
+        for a metric
+
+        Carbon patterns are searched against the whole metric name, so the
+        schema lookup itself can't be shared between metrics, but everything
+        derived from the matching schemas is looked up in resolvedSchemas.
+
+        Parameters:
+            metric      - graphite metric name
+
+        Returns a tuple of ((secondsPerPoint, points) per archive, retentions
+        string, xFilesFactor, xFilesFactor as stored in a whisper header,
+        aggregationMethod)
+    """
+    return resolvedSchemas[findStorageSchema(metric), findAggregationSchema(metric)]
+
 
 # check to see if a metric needs to be resized based on the current config
-def processMetric(fullPath, schemas, agg_schemas):
+def processMetric(fullPath):
     """
         method to process a given metric, and resize it if necessary
 
         Parameters:
             fullPath    - full path to the metric whisper file
-            schemas     - carbon storage schemas loaded from config
-            agg_schemas - carbon storage aggregation schemas load from confg
 
+        Returns the exit code of the resize, 0 if nothing was run
     """
-    schema_config_args = ''
-    schema_file_args = ''
     rebuild = False
     messages = ''
 
@@ -120,51 +308,32 @@ def processMetric(fullPath, schemas, agg_schemas):
     # get graphite metric name from fullPath
     metric = getMetricFromPath(fullPath)
 
-    # loop the carbon-storage schemas
-    for schema in schemas:
-        if schema.matches(metric):
-            # returns secondsPerPoint and points for this schema in tuple format
-            archive_config = [archive.getTuple() for archive in schema.archives]
-            break
-
-    # loop through the carbon-aggregation schemas
-    for agg_schema in agg_schemas:
-        if agg_schema.matches(metric):
-            xFilesFactor, aggregationMethod = agg_schema.archives
-            break
-
-    if xFilesFactor is None:
-        xFilesFactor = 0.5
-    if aggregationMethod is None:
-        aggregationMethod = 'average'
-
-    # loop through the bucket tuples and convert to string format for resizing
-    for retention in archive_config:
-        current_schema = '%s:%s ' % (retention[0], retention[1])
-        schema_config_args += current_schema
+    retentions, schema_config_args, xFilesFactor, storedXFilesFactor, \
+        aggregationMethod = resolveSchemas(metric)
 
-    # loop through the current files bucket sizes and convert to string format
-    # to compare for resizing
-    for fileRetention in info['archives']:
-        current_schema = '%s:%s ' % (fileRetention['secondsPerPoint'], fileRetention['points'])
-        schema_file_args += current_schema
+    fileRetentions = tuple((fileRetention['secondsPerPoint'], fileRetention['points'])
+                           for fileRetention in info['archives'])
 
     # check to see if the current and configured schemas are the same or rebuild
-    if (schema_config_args != schema_file_args):
+    if (retentions != fileRetentions):
         rebuild = True
+        # only formatted for the message when they differ
+        schema_file_args = ''.join('%s:%s ' % fileRetention
+                                   for fileRetention in fileRetentions)
         messages += 'updating Retentions from: %s to: %s \n' % \
                     (schema_file_args, schema_config_args)
 
+    # check to see if the current and configured xFilesFactor are the same.
     # only care about the first two decimals in the comparison since there is
-    # floaty stuff going on.
-    info_xFilesFactor = "{0:.2f}".format(info['xFilesFactor'])
-    str_xFilesFactor = "{0:.2f}".format(xFilesFactor)
-
-    # check to see if the current and configured xFilesFactor are the same
-    if (str_xFilesFactor != info_xFilesFactor):
-        rebuild = True
-        messages += '%s xFilesFactor differs real: %s should be: %s \n' % \
-                    (metric, info_xFilesFactor, str_xFilesFactor)
+    # floaty stuff going on, but a file that already has the configured value
+    # matches exactly and doesn't need formatting.
+    if info['xFilesFactor'] != storedXFilesFactor:
+        info_xFilesFactor = "{0:.2f}".format(info['xFilesFactor'])
+        str_xFilesFactor = "{0:.2f}".format(xFilesFactor)
+        if (str_xFilesFactor != info_xFilesFactor):
+            rebuild = True
+            messages += '%s xFilesFactor differs real: %s should be: %s \n' % \
+                        (metric, info_xFilesFactor, str_xFilesFactor)
     # check to see if the current and configured aggregationMethods are the same
     if (aggregationMethod != info['aggregationMethod']):
         rebuild = True
@@ -174,16 +343,15 @@ def processMetric(fullPath, schemas, agg_schemas):
     # if we need to rebuild, lets do it.
     if rebuild is True:
         cmd = [whisperResizeExecutable, fullPath]
-        for x in shlex.split(options.extra_args):
-            cmd.append(x)
+        cmd.extend(extraArgs)
         cmd.append('--xFilesFactor=' + str(xFilesFactor))
         cmd.append('--aggregationMethod=' + str(aggregationMethod))
-        for x in shlex.split(schema_config_args):
-            cmd.append(x)
+        cmd.extend('%s:%s' % retention for retention in retentions)
 
         if options.quiet is not True or options.confirm is True:
-            print(messages)
-            print(cmd)
+            with outputLock:
+                print(messages)
+                print(cmd)
 
         if options.confirm is True:
             options.doit = confirm("Would you like to run this command? [y/n]: ")
@@ -191,11 +359,43 @@ def processMetric(fullPath, schemas, agg_schemas):
                 print("Skipping command \n")
 
         if options.doit is True:
-            exitcode = call(cmd)
-            # if the command failed lets bail so we can take a look before proceeding
+            exitcode = runResize(cmd, info)
             if (exitcode > 0):
-                print('Error running: %s' % (cmd))
-                sys.exit(1)
+                with outputLock:
+                    print('Error running: %s' % (cmd))
+            return exitcode
+    return 0
+
+
+def runResize(cmd, info=None):
+    """
+        run whisper-resize, in-process if it has been loaded
+
+        Parameters:
+            cmd  - the whisper-resize command line
+            info - whisper.info of the file, saves re-reading it in-process
+
+        Returns the exit code of the resize
+    """
+    if whisperResize is None:
+        with resizeSemaphore:
+            return call(cmd)
+
+    # whisper-resize prints as it goes, so keep other output out of the way
+    with outputLock:
+        try:
+            whisperResize.main(cmd[1:], info=info)
+        except SystemExit as exc:
+            if exc.code is None:
+                return 0
+            if isinstance(exc.code, int):
+                return exc.code
+            sys.stderr.write('%s\n' % exc.code)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+    return 0
 
 
 def getMetricFromPath(filePath):
@@ -208,15 +408,12 @@ def getMetricFromPath(filePath):
 
         Returns a string representing the metric name
     """
-    # sanitize directory since we may get a trailing slash or not, and if we
-    # don't it creates a leading '.'
-    data_dir = os.path.normpath(settings.LOCAL_DATA_DIR) + os.sep
-
     # pull the data dir off and convert to the graphite metric name
-    metric_name = filePath.replace(data_dir, '')
-    metric_name = metric_name.replace('.wsp', '')
-    metric_name = metric_name.replace('/', '.')
-    return metric_name
+    if filePath.startswith(dataDirPrefix):
+        filePath = filePath[len(dataDirPrefix):]
+    if filePath.endswith('.wsp'):
+        filePath = filePath[:-4]
+    return filePath.replace('/', '.')
 
 
 def confirm(question, error_response='Valid options : yes or no'):
@@ -236,11 +433,57 @@ def confirm(question, error_response='Valid options : yes or no'):
         print(error_response)
 
 
+def walkWhisperFiles(dirPath):
+    """
+        yield the path of every whisper file below dirPath
+
+        Uses scandir so the file type comes from the directory entry itself
+        instead of a separate stat call per file.
+
+        Parameters:
+            dirPath - directory to search for whisper files
+    """
+    if scandir is None:
+        for root, _, files in os.walk(dirPath):
+            for f in files:
+                if f.endswith('.wsp'):
+                    yield os.path.join(root, f)
+        return
+
+    try:
+        entries = list(scandir(dirPath))
+    except OSError:
+        # unreadable directories are skipped, just like os.walk does
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            for fullPath in walkWhisperFiles(entry.path):
+                yield fullPath
+        elif entry.name.endswith('.wsp') and not entry.is_dir():
+            yield entry.path
+
+
 if os.path.isfile(processPath) and processPath.endswith('.wsp'):
-    processMetric(processPath, schemas, agg_schemas)
+    metricPaths = [processPath]
 else:
-    for root, _, files in os.walk(processPath):
-        # we only want to deal with non-hidden whisper files
-        for f in fnmatch.filter(files, '*.wsp'):
-            fullpath = os.path.join(root, f)
-            processMetric(fullpath, schemas, agg_schemas)
+    metricPaths = walkWhisperFiles(processPath)
+
+if options.confirm is True or options.jobs == 1:
+    # prompts have to be answered one metric at a time, and one job needs no pool
+    pool = None
+    exitcodes = (processMetric(fullpath) for fullpath in metricPaths)
+else:
+    pool = ThreadPool(options.jobs)
+    exitcodes = pool.imap_unordered(processMetric, metricPaths)
+
+try:
+    for exitcode in exitcodes:
+        # if the command failed lets bail so we can take a look before proceeding
+        if (exitcode > 0):
+            sys.exit(1)
+finally:
+    if pool is not None:
+        # terminate stops queued metrics, resizes already running are waited for
+        pool.terminate()
+        pool.join()
@@ -26,7 +26,10 @@ signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 now = int(time.time())
 yesterday = now - (60 * 60 * 24)
 
-option_parser = optparse.OptionParser(usage='''%prog [options] path''')
+option_parser = optparse.OptionParser(usage='''%prog [options] path
+
+Give - as the path to read paths from stdin, one per line, and update them
+all from this one process.''')
 option_parser.add_option(
   '--from', default=yesterday, type='int', dest='_from',
   help=("Unix epoch time of the beginning of "
@@ -44,33 +47,60 @@ if len(args) < 1:
   option_parser.print_usage()
   sys.exit(1)
 
-path = args[0]
 from_time = int(options._from)
 until_time = int(options.until)
 
-try:
-  data = whisper.fetch(path, from_time, until_time)
-  if not data:
-    raise SystemExit('No data in selected timerange')
-  (timeInfo, values_old) = data
-except whisper.WhisperException as exc:
-  raise SystemExit('[ERROR] %s' % str(exc))
-
-(start, end, step) = timeInfo
-t = start
-for value_old in values_old:
-  value_str_old = str(value_old)
-  value_new = update_value(t, value_old)
-  value_str_new = str(value_new)
-  if options.pretty:
-    timestr = time.ctime(t)
-  else:
-    timestr = str(t)
-
-  print("%s\t%s -> %s" % (timestr, value_str_old, value_str_new))
+
+def update_path(path):
   try:
+    data = whisper.fetch(path, from_time, until_time)
+    if not data:
+      raise SystemExit('No data in selected timerange')
+    (timeInfo, values_old) = data
+  except whisper.WhisperException as exc:
+    raise SystemExit('[ERROR] %s' % str(exc))
+
+  (start, end, step) = timeInfo
+  # written back in one go, rather than opening the file again for each point
+  points = []
+  t = start
+  for value_old in values_old:
+    value_str_old = str(value_old)
+    value_new = update_value(t, value_old)
+    value_str_new = str(value_new)
+    if options.pretty:
+      timestr = time.ctime(t)
+    else:
+      timestr = str(t)
+
+    print("%s\t%s -> %s" % (timestr, value_str_old, value_str_new))
     if value_new is not None:
-      whisper.update(path, value_new, t)
+      points.append((t, value_new))
     t += step
+
+  try:
+    whisper.update_many(path, points)
   except whisper.WhisperException as exc:
     raise SystemExit('[ERROR] %s' % str(exc))
+
+
+if args[0] != '-':
+  update_path(args[0])
+else:
+  failed = False
+  for line in sys.stdin:
+    path = line.strip()
+    if not path:
+      continue
+    print(path)
+    try:
+      update_path(path)
+    except SystemExit as exc:
+      # carry on with the other paths, but still report the failure
+      sys.stderr.write('%s: %s\n' % (path, exc.code))
+      failed = True
+    except (IOError, OSError) as exc:
+      sys.stderr.write('%s: [ERROR] %s\n' % (path, exc))
+      failed = True
+  if failed:
+    sys.exit(1)
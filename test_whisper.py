@@ -965,5 +965,267 @@ class TestCorruptWhisperFile(unittest.TestCase):
             )
 
 
+def load_script(relPath, name):
+    """load one of the bin/ or contrib/ scripts as a module"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), relPath)
+    try:
+        from importlib.machinery import SourceFileLoader
+        from importlib.util import module_from_spec, spec_from_loader
+    except ImportError:
+        import imp
+        module = imp.load_source(name, path)
+    else:
+        loader = SourceFileLoader(name, path)
+        module = module_from_spec(spec_from_loader(name, loader))
+        loader.exec_module(module)
+    return module
+
+
+class TestUpdateStorageTimesSchemas(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.ust = load_script('contrib/update-storage-times.py',
+                                   'update_storage_times')
+        except ImportError as exc:
+            self.skipTest('update-storage-times needs %s' % exc)
+        self.conf = 'storage-schemas.conf'
+
+    def tearDown(self):
+        try:
+            os.unlink(self.conf)
+        except OSError:
+            pass
+
+    def _config(self, text):
+        with open(self.conf, 'w') as fh:
+            fh.write(text)
+        self.ust.config_schemas(self.conf)
+
+    def _search_each(self, name):
+        """the schema the plain per-pattern search picks"""
+        for item, info in self.ust.SCHEMA_LIST.items():
+            if info['match'].search(name):
+                return info
+        return self.ust.DEFAULT_SCHEMA
+
+    def test_combined(self):
+        self._config(
+            '[servers]\npattern = ^servers\\.\nretentions = 10s:1d,1m:7d\n'
+            '[count]\npattern = \\.count$\nretentions = 1m:7d\n'
+            '[default]\npattern = .*\nretentions = 5m:30d\n')
+        self.assertIsNotNone(self.ust.SCHEMA_MATCH)
+        for name in ('servers.a.count', 'apps.b.count', 'servers.a.cpu',
+                     'apps.servers.cpu', 'count'):
+            self.assertIs(self.ust._find_schema(name), self._search_each(name))
+        self.assertEqual(self.ust._find_schema('apps.b.cpu')['retentions'],
+                         ['5m:30d'])
+        self.assertEqual(self.ust._find_schema('apps.b.count')['parsed_retentions'],
+                         [604800])
+
+    def test_inline_flags(self):
+        # (?i) must only apply to its own schema, not the case sensitive one
+        self._config(
+            '[servers]\npattern = ^Servers\\.\nretentions = 10s:1d\n'
+            '[cpu]\npattern = (?i)\\.cpu$\nretentions = 1m:7d\n'
+            '[default]\npattern = .*\nretentions = 5m:30d\n')
+        self.assertIsNone(self.ust.SCHEMA_MATCH)
+        for name in ('servers.a.cpu', 'Servers.a.CPU', 'servers.a.mem',
+                     'Servers.a.mem', 'x.CPU'):
+            self.assertIs(self.ust._find_schema(name), self._search_each(name))
+        self.assertEqual(self.ust._find_schema('servers.a.mem')['retentions'],
+                         ['5m:30d'])
+        self.assertEqual(self.ust._find_schema('Servers.a.mem')['retentions'],
+                         ['10s:1d'])
+        self.assertEqual(self.ust._find_schema('x.CPU')['retentions'],
+                         ['1m:7d'])
+
+
+class TestWhisperFill(unittest.TestCase):
+    now = 1700000000
+
+    def setUp(self):
+        self.fill = load_script('bin/whisper-fill.py', 'whisper_fill')
+        self.src = 'fill-src.wsp'
+        self.dst = 'fill-dst.wsp'
+        self.ref = 'fill-ref.wsp'
+
+    def tearDown(self):
+        for path in (self.src, self.dst, self.ref):
+            WhisperTestBase._remove(path)
+
+    def _populate(self, path, archives, density, rand):
+        whisper.create(path, archives)
+        for (step, points) in sorted(archives, key=lambda a: a[0] * a[1], reverse=True):
+            whisper.update_many(
+                path,
+                [(self.now - i * step, rand.random() * 100)
+                 for i in range(points) if rand.random() < density],
+                now=self.now)
+
+    def test_touching_gaps_stay_separate(self):
+        # a single present point between two gaps still splits them: the
+        # archive windows of each gap have to be written in turn
+        self.assertEqual(
+            self.fill.find_gaps((0, 70, 10), [1, None, None, 1, None, None, 1], 10),
+            [(0, 30), (30, 60)])
+
+    def test_fill_archives_matches_gap_by_gap(self):
+        rand = random.Random(57)
+        self._populate(self.src, [(10, 360), (60, 600), (300, 500)], 0.9, rand)
+        self._populate(self.dst, [(60, 1440), (600, 300)], 0.6, rand)
+        with open(self.dst, 'rb') as src, open(self.ref, 'wb') as dst:
+            dst.write(src.read())
+
+        with patch('time.time', return_value=self.now):
+            self.fill.fill_archives(self.src, self.dst, self.now)
+
+            # the same, one fill() per gap
+            startFrom = self.now
+            archives = sorted(whisper.info(self.ref)['archives'],
+                              key=lambda a: a['retention'])
+            for archive in archives:
+                fromTime = self.now - archive['retention']
+                (timeInfo, values) = whisper.fetch(self.ref, fromTime, startFrom)
+                for (tstart, tstop) in self.fill.find_gaps(
+                        timeInfo, values, archive['secondsPerPoint']):
+                    self.fill.fill(self.src, self.ref, tstart, tstop)
+                startFrom = fromTime
+
+        with open(self.dst, 'rb') as filled, open(self.ref, 'rb') as ref:
+            self.assertEqual(filled.read(), ref.read())
+
+
+class TestWhisperResize(unittest.TestCase):
+    # on a boundary of every step used below
+    now = 1699999800
+
+    def setUp(self):
+        self.resize = load_script('bin/whisper-resize.py', 'whisper_resize')
+        self.filename = 'resize.wsp'
+        self.newfile = 'resize-new.wsp'
+
+    def tearDown(self):
+        for path in (self.filename, self.newfile, self.filename + '.bak',
+                     self.filename + '.tmp'):
+            WhisperTestBase._remove(path)
+
+    def _create(self, archives, density=1.0, seed=1, **kwargs):
+        rand = random.Random(seed)
+        whisper.create(self.filename, archives, **kwargs)
+        for (step, points) in sorted(archives, key=lambda a: a[0] * a[1], reverse=True):
+            whisper.update_many(
+                self.filename,
+                [(self.now - i * step, rand.random() * 100)
+                 for i in range(points) if rand.random() < density],
+                now=self.now)
+
+    def _resize(self, *args):
+        out = StringIO()
+        with patch('time.time', return_value=self.now), \
+                patch('sys.stdout', out):
+            try:
+                self.resize.main(list(args))
+            except SystemExit as exc:
+                self.assertFalse(exc.code)
+        return out.getvalue()
+
+    def _fetch(self, path):
+        """the day of points a resize carries over: the oldest one of the
+        old file and the one at now (when aggregating) are left out"""
+        return whisper.fetch(path, self.now - 86400 + 60, self.now - 60,
+                             now=self.now)
+
+    def test_same_layout_skipped(self):
+        self._create([(60, 1440), (600, 300)])
+        inode = os.stat(self.filename).st_ino
+        # retentions given in another order and spelling are still the same
+        out = self._resize(self.filename, '10m:50h', '1m:1d')
+        self.assertIn('No change, skipping: %s' % self.filename, out)
+        self.assertEqual(os.stat(self.filename).st_ino, inode)
+        self.assertFalse(os.path.exists(self.filename + '.bak'))
+
+    def test_xff_compared_as_stored(self):
+        # 0.1 is not exact once stored as a float32 in the header
+        self._create([(60, 1440)], xFilesFactor=0.1)
+        self.assertNotEqual(whisper.info(self.filename)['xFilesFactor'], 0.1)
+        out = self._resize(self.filename, '1m:1d', '--xFilesFactor=0.1')
+        self.assertIn('No change, skipping', out)
+
+        out = self._resize(self.filename, '1m:1d', '--xFilesFactor=0.2')
+        self.assertNotIn('No change, skipping', out)
+        self.assertTrue(os.path.exists(self.filename + '.bak'))
+        self.assertAlmostEqual(whisper.info(self.filename)['xFilesFactor'], 0.2,
+                               places=6)
+
+    def test_changes_not_skipped(self):
+        self._create([(60, 1440)], density=0.8)
+        before = self._fetch(self.filename)
+
+        out = self._resize(self.filename, '1m:1d', '--aggregationMethod=max')
+        self.assertNotIn('No change, skipping', out)
+        self.assertEqual(whisper.info(self.filename)['aggregationMethod'], 'max')
+        self.assertEqual(self._fetch(self.filename), before)
+
+        out = self._resize(self.filename, '1m:2d', '--nobackup')
+        self.assertNotIn('No change, skipping', out)
+        self.assertEqual(whisper.info(self.filename)['maxRetention'], 2 * 86400)
+        self.assertEqual(self._fetch(self.filename), before)
+
+    def test_newfile_not_skipped(self):
+        self._create([(60, 1440)], density=0.8)
+        with open(self.filename, 'rb') as fh:
+            data = fh.read()
+        out = self._resize(self.filename, '1m:1d', '--aggregate',
+                           '--newfile=%s' % self.newfile)
+        self.assertNotIn('No change, skipping', out)
+        self.assertEqual(self._fetch(self.newfile), self._fetch(self.filename))
+        # the original is left alone
+        with open(self.filename, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+    def test_chown_not_skipped(self):
+        self._create([(60, 1440)])
+        inode = os.stat(self.filename).st_ino
+        with patch('os.chown') as chown:
+            out = self._resize(self.filename, '1m:1d', '--nobackup',
+                               '--chown-uid=1000', '--chown-gid=1000')
+        self.assertNotIn('No change, skipping', out)
+        self.assertNotEqual(os.stat(self.filename).st_ino, inode)
+        chown.assert_called_once_with(path=self.filename, uid=1000, gid=1000)
+
+    def test_aggregate(self):
+        oldArchives = [(60, 1440), (600, 300)]
+        self._create(oldArchives, density=0.7, seed=3)
+
+        # every old point, each archive only older than the finer ones
+        points = []
+        cutoff = None
+        for (step, count) in oldArchives:
+            (start, end, step), values = whisper.fetch(
+                self.filename, self.now - step * count + step, self.now,
+                now=self.now)
+            stamps = range(start, end, step)
+            points.extend((t, v) for (t, v) in zip(stamps, values)
+                          if cutoff is None or t < cutoff)
+            cutoff = start
+
+        self._resize(self.filename, '5m:3d', '--aggregate', '--nobackup')
+
+        (start, end, step), values = whisper.fetch(self.filename, 0, self.now,
+                                                   now=self.now)
+        self.assertEqual(step, 300)
+        checked = 0
+        # the interval starting at now is never written by the resize
+        for (t, value) in zip(range(start, self.now, step), values):
+            inside = [v for (ts, v) in points if t <= ts < t + step]
+            known = [v for v in inside if v is not None]
+            if known and float(len(known)) / len(inside) >= 0.5:
+                self.assertAlmostEqual(value, sum(known) / len(known))
+                checked += 1
+            else:
+                self.assertIsNone(value)
+        self.assertTrue(checked > 300)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -35,7 +35,6 @@ import sys
 import time
 
 izip = getattr(itertools, 'izip', zip)
-ifilter = getattr(itertools, 'ifilter', filter)
 
 if sys.version_info >= (3, 0):
   xrange = range
@@ -746,7 +745,7 @@ points is a list of (timestamp,value) points
   if not points:
     return
   points = [(int(t), float(v)) for (t, v) in points]
-  points.sort(key=lambda p: p[0], reverse=True)  # Order points by timestamp, newest first
+  points.sort(key=operator.itemgetter(0), reverse=True)  # Order points by timestamp, newest first
   with open(path, 'r+b', BUFFERING) as fh:
     if CAN_FADVISE and FADVISE_RANDOM:
       posix_fadvise(fh.fileno(), 0, 0, POSIX_FADV_RANDOM)
@@ -797,10 +796,12 @@ def __archive_update_many(fh, header, archive, points):
   step = archive['secondsPerPoint']
   alignedPoints = [(timestamp - (timestamp % step), value)
                    for (timestamp, value) in points]
-  # Create a packed string for each contiguous sequence of points
+  # Create a packed string for each contiguous sequence of points. Each run
+  # is collected as a list and joined once, as growing a bytes object point
+  # by point copies the whole run every time.
   packedStrings = []
   previousInterval = None
-  currentString = b""
+  currentRun = []
   lenAlignedPoints = len(alignedPoints)
   for i in xrange(0, lenAlignedPoints):
     # Take last point in run of points with duplicate intervals
@@ -808,18 +809,16 @@ def __archive_update_many(fh, header, archive, points):
       continue
     (interval, value) = alignedPoints[i]
     if (not previousInterval) or (interval == previousInterval + step):
-      currentString += struct.pack(pointFormat, interval, value)
+      currentRun.append(struct.pack(pointFormat, interval, value))
       previousInterval = interval
     else:
-      numberOfPoints = len(currentString) // pointSize
-      startInterval = previousInterval - (step * (numberOfPoints - 1))
-      packedStrings.append((startInterval, currentString))
-      currentString = struct.pack(pointFormat, interval, value)
+      startInterval = previousInterval - (step * (len(currentRun) - 1))
+      packedStrings.append((startInterval, b"".join(currentRun)))
+      currentRun = [struct.pack(pointFormat, interval, value)]
       previousInterval = interval
-  if currentString:
-    numberOfPoints = len(currentString) // pointSize
-    startInterval = previousInterval - (step * (numberOfPoints - 1))
-    packedStrings.append((startInterval, currentString))
+  if currentRun:
+    startInterval = previousInterval - (step * (len(currentRun) - 1))
+    packedStrings.append((startInterval, b"".join(currentRun)))
 
   # Read base point and determine where our writes will start
   fh.seek(archive['offset'])
@@ -1086,11 +1085,10 @@ def file_merge(fh_from, fh_to, time_from=None, time_to=None, now=None):
       continue
     (timeInfo, values) = __archive_fetch(fh_from, archive, archiveFrom, archiveTo)
     (start, end, archive_step) = timeInfo
-    pointsToWrite = list(ifilter(
-      lambda points: points[1] is not None,
-      izip(xrange(start, end, archive_step), values)))
+    pointsToWrite = [point for point in izip(xrange(start, end, archive_step), values)
+                     if point[1] is not None]
     # skip if there are no points to write
-    if len(pointsToWrite) == 0:
+    if not pointsToWrite:
       continue
     __archive_update_many(fh_to, headerTo, archive, pointsToWrite)
 
@@ -1135,15 +1133,21 @@ def file_diff(fh_from, fh_to, ignore_empty=False, until_time=None, now=None):
          max(fromTimeInfo[1], toTimeInfo[1]),
          min(fromTimeInfo[2], toTimeInfo[2]))
 
-    points = map(lambda s: (s * archive_step + start, fromValues[s], toValues[s]),
-                 xrange(0, (end - start) // archive_step))
-    if ignore_empty:
-      points = [p for p in points if p[1] is not None and p[2] is not None]
-    else:
-      points = [p for p in points if p[1] is not None or p[2] is not None]
-
-    diffs = [p for p in points if p[1] != p[2]]
-
-    archive_diffs.append((archive_number, diffs, points.__len__()))
+    untilStep = start + (end - start) // archive_step * archive_step
+    points = izip(xrange(start, untilStep, archive_step), fromValues, toValues)
+
+    # Count the compared points and collect the differing ones in one pass
+    total = 0
+    for point in points:
+      if point[1] is None or point[2] is None:
+        # points empty in both files are never compared, points empty in
+        # either one are skipped when asked to ignore empty values
+        if ignore_empty or point[1] is point[2]:
+          continue
+      total += 1
+      if point[1] != point[2]:
+        diffs.append(point)
+
+    archive_diffs.append((archive_number, diffs, total))
     untilTime = min(startTime, untilTime)
   return archive_diffs